@@ -36,10 +36,18 @@ board 文件中增加了几个配置项：
 - build.system_file: system s文件的文件名，未指定则用product_line 拼接：f{system_{product_line}.s}
 - build.use_device_pack_startup: 允许在device_pack 中查找startup 文件（true）
 - build.use_device_pack_system: 允许在device_pack 中查找system 文件（true）
+- build.use_ccache: PATH 中存在ccache 时，用ccache 包装CC 和CXX（false）
 - debug.svd_name: svd 文件的文件名，未指定则用product_line 拼接：f{{product_line}.svd}
 
 
 
+编译缓存：
+- 如果platformio.ini 的[platformio] 中没有设置build_cache_dir，默认使用$PROJECT_WORKSPACE_DIR/build_cache（即.pio/build_cache）
+- board 文件中设置build.use_build_cache = false，或在platformio.ini 中设置board_build.use_build_cache = false，
+  可关闭默认的编译缓存
+- 默认缓存只在当前项目的env 之间共享，没有大小限制，删除.pio/build_cache 文件夹（或整个.pio）即可清空
+- 所有env 可以设置同一个build_cache_dir，共享编译结果
+
 board 文件中废弃的配置项：
 - svd_path
 - frameworks: 不支持任何框架，如果需要，只能将其作为库手动引入
@@ -52,12 +60,15 @@ device pack 的文件结构：
 
 import glob
 import os
+import shutil
 import string
 import sys
 
+from fnmatch import fnmatch
+from functools import cache
 from pathlib import Path
-from itertools import chain
-from typing import List, Optional, Iterable
+from itertools import islice
+from typing import Dict, List, Optional, Iterable, Iterator, Set
 
 from platformio.project.helpers import get_project_dir, get_project_all_lib_dirs
 
@@ -66,8 +77,39 @@ from SCons.Script import DefaultEnvironment
 env = DefaultEnvironment()
 
 board = env.BoardConfig()
-mcu: str = board.get("build.mcu", "")
-product_line: str = board.get("build.product_line", "")
+
+# 一次性读取board 配置，后续查找函数都从这份快照里取值，不再反复调用board.get
+_SENTINEL = object()
+_BOARD_KEYS = (
+    "build.mcu",
+    "build.product_line",
+    "device_pack",
+    "device_include",
+    "debug.svd_name",
+    "debug.svd_path",
+    "build.ldscript",
+    "build.startup_file",
+    "build.system_file",
+    "build.use_device_pack_startup",
+    "build.use_device_pack_system",
+    "build.use_ccache",
+    "build.use_build_cache",
+)
+_BOARD_CACHE = {k: board.get(k, _SENTINEL) for k in _BOARD_KEYS}
+_BOARD_CACHE = {k: v for k, v in _BOARD_CACHE.items() if v is not _SENTINEL}
+
+
+def get_board_flag(key: str, default: bool) -> bool:
+    '''
+    platformio.ini 中的board_build.xxx 都是字符串，"false"/"no"/"0" 之类也要当作false
+    '''
+    value = _BOARD_CACHE.get(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() not in ('false', 'no', 'off', '0', '')
+    return bool(value)
+
+mcu: str = _BOARD_CACHE.get("build.mcu", "")
+product_line: str = _BOARD_CACHE.get("build.product_line", "")
 assert product_line, "Missing MCU or Product Line field"
 
 env.SConscript("_bare.py")
@@ -76,7 +118,50 @@ env.SConscript("_bare.py")
 project_path = Path(get_project_dir())
 project_misc = project_path / 'misc'
 project_src = project_path / 'src'
-lib_path_list = [Path(p) for p in get_project_all_lib_dirs()]
+lib_path_list: List[str] = get_project_all_lib_dirs()
+
+
+def build_pack_index(lib_dirs: Iterable[str]) -> Dict[str, List[str]]:
+    '''
+    库名 -> 所有库文件夹中同名库的路径。同一个库可能同时出现在多个库文件夹中，所以值是列表，用于检查重复
+    '''
+    index: Dict[str, List[str]] = {}
+    for lib_dir in lib_dirs:
+        if not os.path.isdir(lib_dir):
+            continue
+        with os.scandir(lib_dir) as it:
+            for e in it:
+                index.setdefault(e.name, []).append(e.path)
+    return index
+
+
+# 每个库文件夹只列一次目录，查找器件库时直接查字典。只在真正需要器件库时才扫描
+@cache
+def get_pack_index() -> Dict[str, List[str]]:
+    return build_pack_index(lib_path_list)
+
+
+# 器件库只在misc 中找不到ld/svd、需要引入头文件或需要编译器件库中的源文件时才查找，且只查找一次
+@cache
+def get_pack() -> Optional[Path]:
+    print(f'--> Finding device pack in: {lib_path_list}')
+    pack = find_device_pack_path()
+    if pack is not None:
+        print(f'--> Device pack selected: {pack}')
+    return pack
+
+
+# 器件库路径只解析一次，后续拼接相对路径和编译源文件都复用这个结果
+@cache
+def get_pack_resolved() -> Path:
+    pack = get_pack()
+    assert pack is not None
+    return pack.resolve()
+
+
+@cache
+def get_pack_posix() -> str:
+    return get_pack_resolved().as_posix()
 
 
 # CMSIS_DIR = platform.get_package_dir("framework-cmsis")
@@ -87,11 +172,56 @@ lib_path_list = [Path(p) for p in get_project_all_lib_dirs()]
 
 # delete frameworks in board config
 def do_not_support_any_framework():
-    board.update('frameworks', [])
+    if board.get('frameworks', None):
+        board.update('frameworks', [])
+
+
+def match_path_parts(entry: os.DirEntry, parts: List[str]) -> Iterator[Path]:
+    '''
+    entry 匹配parts[0] 后，逐层向下匹配剩余的部分
+    '''
+    if not fnmatch(entry.name, parts[0]):
+        return
+    if len(parts) == 1:
+        yield Path(entry.path)
+    elif entry.is_dir():
+        try:
+            it = os.scandir(entry.path)
+        except OSError:
+            return
+        with it:
+            for e in it:
+                yield from match_path_parts(e, parts[1:])
 
 
 def two_layer_glob(folder: Path, name: str) -> Iterable[Path]:
-    return chain(folder.glob(name), folder.glob(f'*/{name}'))
+    '''
+    相当于chain(folder.glob(name), folder.glob(f'*/{name}'))，但第一层目录只遍历一次。
+    和Path.glob 一样，跳过无法读取的子文件夹
+    '''
+    if not folder.is_dir():
+        return
+    parts = name.split('/')
+    with os.scandir(folder) as it:
+        for e in it:
+            yield from match_path_parts(e, parts)
+            if not e.is_dir():
+                continue
+            try:
+                sub_it = os.scandir(e.path)
+            except OSError:
+                continue
+            with sub_it:
+                for sub_e in sub_it:
+                    yield from match_path_parts(sub_e, parts)
+
+
+def find_at_most_two(folder: Path, parent: str, pattern: str) -> List[Path]:
+    '''
+    在folder 的前两层中查找parent/pattern，文件名在遍历过程中直接匹配，pattern 支持通配符。
+    找到第二个结果时就停止遍历，只用来判断结果是否唯一，所以最多返回两个路径。
+    '''
+    return list(islice(two_layer_glob(folder, f'{parent}/{pattern}'), 2))
 
 
 def find_device_pack_path() -> Optional[Path]:
@@ -104,44 +234,44 @@ def find_device_pack_path() -> Optional[Path]:
 
     器件库可以放在两个位置，.pio/lib_deps 或lib，同一个器件库不能同时放在两个位置
     '''
-    board_pack_name = board.get('device_pack', None)
-    product_line_pack_name = f'device_path_{product_line}'
+    board_pack_name = _BOARD_CACHE.get('device_pack', None)
+    product_line_pack_name = f'device_pack_{product_line}'
 
-    find_pack = lambda name: chain(*[p.glob(name) for p in lib_path_list])
+    find_pack = lambda name: get_pack_index().get(name, [])
 
     if board_pack_name is not None:
-        board_pack_name_list = list(find_pack(board_pack_name))
-        list_len = len(board_pack_name_list)
-        assert list_len <= 0, f'Found more than one device pack [ {board_pack_name} ].'
-
-        if len(board_pack_name_list) == 1:
-            return board_pack_name_list[0]
-
-    product_line_name_pack_list = list(find_pack(product_line_pack_name))
-    list_len = len(product_line_name_pack_list)
-    assert list_len < 2, f'Found more than one device pack [ {product_line_pack_name} ].'
-    if list_len == 0:
+        hits = find_pack(board_pack_name)
+        assert len(hits) < 2, f'Found more than one device pack [ {board_pack_name} ].'
+        if hits:
+            return Path(hits[0])
+
+    hits = find_pack(product_line_pack_name)
+    assert len(hits) < 2, f'Found more than one device pack [ {product_line_pack_name} ].'
+    if not hits:
         print(f'?-> Device pack [ {product_line_pack_name} ] not found.')
         return None
-    else:
-        return product_line_name_pack_list[0]
+    return Path(hits[0])
 
 
-def find_header_path_in_device_pack(pack_dir: Path) -> List[Path]:
+def find_header_path_in_device_pack() -> List[str]:
     '''
     器件库中包含器件的寄存器头文件，但位置并不统一，所以要在board 文件中用"device_include": [] 指定。
     器件库中可能包含CMSIS 头文件，也可以用这种方式添加，但是HAL 或LL 库文件不行。
     简单起见，除了启动文件和system_xxx.c，器件库只会引入头文件，不包括源文件，所以不能把包含源文件的库放在这里。
     '''
-    include_list = board.get("device_include", {})
+    include_list = _BOARD_CACHE.get("device_include", {})
     if len(include_list) == 0:
         return []
 
-    include_path_list = [pack_dir / p for p in include_list]
-    return include_path_list
+    pack_dir = get_pack()
+    if pack_dir is None:
+        return []
 
+    pack_dir_str = str(pack_dir)
+    return [os.path.join(pack_dir_str, p) for p in include_list]
 
-def find_svd_file_path(pack_dir: Optional[Path]) -> Optional[Path]:
+
+def find_svd_file_path() -> Optional[Path]:
     '''
     优先在misc 文件夹中寻找符合要求的svd 文件，没找到则继续在器件库中搜索。
     svd 文件名在board 文件中定义，推荐定为debug.svd_name，
@@ -149,27 +279,30 @@ def find_svd_file_path(pack_dir: Optional[Path]) -> Optional[Path]:
 
     找到svd 文件的路径后，board 文件设置的svd_path 将被覆盖，不更改源json 文件
     '''
-    svd_name = board.get("debug.svd_name", None)
+    svd_name = _BOARD_CACHE.get("debug.svd_name", None)
     if svd_name is None:
-        svd_name = board.get("debug.svd_path", None)
+        svd_name = _BOARD_CACHE.get("debug.svd_path", None)
         if svd_name is None:
             svd_name = f'{product_line}.svd'
 
     svd_in_misc: Path = project_misc / svd_name
-    if svd_in_misc.exists():
+    if os.path.isfile(str(svd_in_misc)):
         return svd_in_misc
 
+    pack_dir = get_pack()
     if pack_dir is None:
         return None
-    all_svd = two_layer_glob(pack_dir, 'SVD/*.svd')
-    target_svd = list(filter(lambda f: f.name == svd_name, all_svd))
+    # 和SVD/*.svd 中按文件名精确匹配一致：只接受不带路径的文件名，不做通配符处理，且必须是.svd 文件
+    if os.path.basename(svd_name) != svd_name or not fnmatch(svd_name, '*.svd'):
+        return None
+    target_svd = find_at_most_two(pack_dir, 'SVD', glob.escape(svd_name))
     if len(target_svd) == 1:
         return target_svd[0]
     else:
         return None
 
 
-def find_ldscript_file_path(pack_dir: Optional[Path]) -> Optional[Path]:
+def find_ldscript_file_path() -> Optional[Path]:
     '''
     优先在misc 文件夹中寻找符合要求的ld 文件，没找到则继续在器件库中搜索。
     svd 文件名在board 文件中定义，推荐定为build.ldscript，
@@ -179,18 +312,21 @@ def find_ldscript_file_path(pack_dir: Optional[Path]) -> Optional[Path]:
 
     找到svd 文件的路径后，board 文件设置的svd_path 将被覆盖，不更改源json 文件
     '''
-    ld_name = board.get("build.ldscript", None)
+    ld_name = _BOARD_CACHE.get("build.ldscript", None)
     if ld_name is None:
         ld_name = f'{product_line}.ld'
 
     ld_in_misc: Path = project_misc / ld_name
-    if ld_in_misc.exists():
+    if os.path.isfile(str(ld_in_misc)):
         return ld_in_misc
 
+    pack_dir = get_pack()
     if pack_dir is None:
         return None
-    all_ld = two_layer_glob(pack_dir, 'Ldscript/*.ld')
-    target_ld = list(filter(lambda f: f.name == ld_name, all_ld))
+    # 和Ldscript/*.ld 中按文件名精确匹配一致：只接受不带路径的文件名，不做通配符处理，且必须是.ld 文件
+    if os.path.basename(ld_name) != ld_name or not fnmatch(ld_name, '*.ld'):
+        return None
+    target_ld = find_at_most_two(pack_dir, 'Ldscript', glob.escape(ld_name))
     if len(target_ld) == 1:
         return target_ld[0]
     else:
@@ -205,7 +341,7 @@ def find_source_file_in_device_pack(pack_dir: Path, parent: str, file_name: str)
 
     器件库中的启动文件必须放在Startup 文件夹下
     '''
-    result = list(two_layer_glob(pack_dir, f'{parent}/{file_name}'))
+    result = find_at_most_two(pack_dir, parent, file_name)
     result_len = len(result)
     if result_len == 0:
         return None
@@ -217,43 +353,56 @@ def find_source_file_in_device_pack(pack_dir: Path, parent: str, file_name: str)
         return None
 
 
+@cache
+def get_src_file_names() -> Set[str]:
+    '''
+    src 及其下一层子文件夹中所有文件的文件名，只遍历一次，供startup 和system 文件共用
+    '''
+    names: Set[str] = set()
+    src_root = str(project_src)
+    # 和Path.glob 一样进入软链接的文件夹，最多只遍历两层，不会陷入循环
+    for root, dirs, files in os.walk(src_root, followlinks=True):
+        names.update(files)
+        if root != src_root:
+            dirs.clear()
+    return names
+
+
 def find_source_file_in_src(file_name: str) -> bool:
     '''
     不检查src 文件夹下是否存在重复的启动文件，src 下的源文件默认都会编译，可能存在子文件夹，
     就算文件名有重复的，也可能是不同的文件，只能假设是用户有意为之
+
+    文件名可以带通配符，比如startup_xxx.[sS]
     '''
-    result = list(two_layer_glob(project_src, file_name))
-    result_len = len(result)
-    if result_len > 0:
+    names = get_src_file_names()
+    if any(fnmatch(n, file_name) for n in names):
         return True
     else:
         print(f'--> No file {file_name} in src.')
         return False
 
 
+@cache
 def get_startup_file_name() -> str:
     file_name = f'startup_{product_line}.[sS]'
-    file_name: str = board.get("build.startup_file", file_name)
+    file_name: str = _BOARD_CACHE.get("build.startup_file", file_name)
     return file_name
 
 
+@cache
 def get_system_file_name() -> str:
     file_name = f'system_{product_line}.c'
-    file_name: str = board.get("build.system_file", file_name)
+    file_name: str = _BOARD_CACHE.get("build.system_file", file_name)
     return file_name
 
 
 do_not_support_any_framework()
 
-env.VerboseAction(f'--> Finding device pack in: {lib_path_list}')
-pack = find_device_pack_path()
-if pack is not None:
-    env.VerboseAction(f'--> Device pack selected: {pack}')
-
 
 # 如果找不到LDSCRIPT，就无法完成编译
 
-ld_path = find_ldscript_file_path(pack)
+ld_path = find_ldscript_file_path()
 if ld_path is None:
     sys.stderr.write(f"!-> Ldscript file not found.")
     raise ValueError('No ldscript file or wrong naming.')
@@ -263,7 +412,7 @@ else:
 
 # 覆盖board 文件的svd_path 参数
 
-svd_path = find_svd_file_path(pack)
+svd_path = find_svd_file_path()
 if svd_path is None:
     sys.stderr.write(f"!-> SVD file not found. Debug feature may not work.")
 else:
@@ -272,10 +421,9 @@ else:
 
 # 按需引入device_pack 中的头文件路径
 
-if pack is not None:
-    header_path_list = find_header_path_in_device_pack(pack)
-    if len(header_path_list) > 0:
-        env.Append(CPPPATH=header_path_list)
+header_path_list = find_header_path_in_device_pack()
+if len(header_path_list) > 0:
+    env.Append(CPPPATH=header_path_list)
 
 
 # The final firmware is linked against standard library with two specifications:
@@ -285,13 +433,33 @@ if pack is not None:
 env.Append(LINKFLAGS=["--specs=nano.specs", "--specs=nosys.specs"])
 
 
+# 未配置build_cache_dir 时启用默认的编译缓存，多个env 编译相同的startup/system 文件时可直接复用目标文件。
+# 缓存放在项目的.pio 中，删除.pio 即可清空
+
+user_build_cache_dir = env.GetProjectConfig().get("platformio", "build_cache_dir", None)
+if get_board_flag('build.use_build_cache', True) and not user_build_cache_dir:
+    build_cache_dir = env.subst(os.path.join("$PROJECT_WORKSPACE_DIR", "build_cache"))
+    os.makedirs(build_cache_dir, exist_ok=True)
+    env.CacheDir(build_cache_dir)
+
+
+# board 文件中设置build.use_ccache = true 且PATH 中能找到ccache 时，用ccache 包装编译器
+
+if get_board_flag('build.use_ccache', False) and shutil.which('ccache'):
+    if not env.subst("$CC").startswith('ccache '):
+        env.Replace(CC=f'ccache {env["CC"]}', CXX=f'ccache {env["CXX"]}')
+        env['ENV']['CCACHE_BASEDIR'] = str(project_path)
+        env['ENV']['CCACHE_SLOPPINESS'] = 'pch_defines,time_macros'
+
+
 # 查找startup 文件
 
 startup_name = get_startup_file_name()
 is_startup_in_src = find_source_file_in_src(startup_name)
 startup_path = None
 if not is_startup_in_src:
-    if board.get('build.use_device_pack_startup', False) and pack is not None:
+    pack = get_pack() if _BOARD_CACHE.get('build.use_device_pack_startup', False) else None
+    if pack is not None:
         startup_path = find_source_file_in_device_pack(pack, 'Startup', startup_name)
     else:
         sys.stderr.write(f"!-> Startup file not found. Ignore this if it's ok.")
@@ -302,38 +470,40 @@ system_name = get_system_file_name()
 is_system_in_src = find_source_file_in_src(system_name)
 system_path = None
 if not is_system_in_src:
-    if board.get('build.use_device_pack_system', False) and pack is not None:
+    pack = get_pack() if _BOARD_CACHE.get('build.use_device_pack_system', False) else None
+    if pack is not None:
         system_path = find_source_file_in_device_pack(pack, 'SystemSource', system_name)
     else:
         sys.stderr.write(f"!-> System file not found. Ignore this if it's ok.")
 
 
-# 编译device_pack 中的startup 文件
+# 编译device_pack 中的startup 和system 文件
 
 
+@cache
 def get_relative_path_to_device_pack(file_path: Path) -> str:
-    assert pack is not None
-    return file_path.resolve().as_posix().removeprefix(f'{pack.resolve().as_posix()}/')
+    '''
+    文件不在器件库中时直接报错，否则src_filter 匹配不到文件，编译时会静默跳过，直到链接时才会出错
+    '''
+    try:
+        return file_path.resolve().relative_to(get_pack_resolved()).as_posix()
+    except ValueError:
+        raise RuntimeError(f'{file_path} not under device pack {get_pack()}') from None
 
 
-def build_source_file_in_device_pack(file_path: Path):
-    assert pack is not None
-    relative_path: str = get_relative_path_to_device_pack(file_path)
+def build_source_files_in_device_pack(file_path_list: List[Path]):
+    '''
+    所有需要从器件库编译的源文件合并到一次BuildSources 调用中，只构建一次SCons 节点
+    '''
+    relative_paths = [get_relative_path_to_device_pack(p) for p in file_path_list]
 
     env.BuildSources(
         os.path.join("$BUILD_DIR", "SourceInDevicePack"),
-        pack.resolve().as_posix(),
-        src_filter=[
-            "-<*>",
-            f"+<{relative_path}>",
-        ],
+        get_pack_posix(),
+        src_filter=["-<*>"] + [f"+<{r}>" for r in relative_paths],
     )
 
 
-if startup_path is not None:
-    build_source_file_in_device_pack(startup_path)
-
-# 编译device_pack 中的system 文件
-
-if system_path is not None:
-    build_source_file_in_device_pack(system_path)
+source_in_pack = [p for p in (startup_path, system_path) if p is not None]
+if len(source_in_pack) > 0:
+    build_source_files_in_device_pack(source_in_pack)